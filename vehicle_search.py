@@ -4,10 +4,37 @@ Busca em uma base de dados de veículos por Marca, Modelo, Ano, Código FIPE, et
 """
 
 import json
-import pandas as pd
-from typing import List, Dict, Optional
-from difflib import SequenceMatcher
+import orjson
+from typing import List, Dict, Optional, Tuple
 import re
+import sys
+from rapidfuzz import fuzz, process
+
+
+# Padrão para Código FIPE (6 dígitos + hífen + 1 dígito)
+_FIPE_RE = re.compile(r'\d{6}-\d')
+
+# Padrão para ano (4 dígitos entre 1900 e 2100)
+_YEAR_RE = re.compile(r'\b(19|20)\d{2}\b')
+
+
+# Campos com poucos valores distintos, compartilhados entre os registros
+_SHARED_VALUE_FIELDS = ('Montadora', 'Tipo veículo', 'Categoria', 'Cota', 'Ano inicial', 'Ano final')
+
+# Faixa usada quando o veículo não tem anos válidos: aceita qualquer ano
+_OPEN_YEAR_RANGE = (-sys.maxsize, sys.maxsize)
+
+
+def _parse_year_range(vehicle: Dict) -> Tuple[int, int]:
+    """Converter a faixa de anos do veículo para inteiros (faixa aberta se ausente ou inválida)"""
+    ano_inicial = vehicle.get('Ano inicial')
+    ano_final = vehicle.get('Ano final')
+    if ano_inicial and ano_final:
+        try:
+            return int(ano_inicial), int(ano_final)
+        except (ValueError, TypeError, OverflowError):
+            pass
+    return _OPEN_YEAR_RANGE
 
 
 class VehicleDatabase:
@@ -15,8 +42,13 @@ class VehicleDatabase:
     
     def __init__(self, json_file: str = '/home/ubuntu/vehicle_database.json'):
         """Inicializar o banco de dados"""
-        with open(json_file, 'r', encoding='utf-8') as f:
-            self.vehicles = json.load(f)
+        with open(json_file, 'rb') as f:
+            data = f.read()
+        try:
+            self.vehicles = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejeita NaN/Infinity (células vazias exportadas da planilha)
+            self.vehicles = json.loads(data)
         
         # Criar índices para busca rápida
         self._create_indexes()
@@ -26,8 +58,19 @@ class VehicleDatabase:
         self.by_fipe = {}
         self.by_brand = {}
         self.by_model = {}
+        # Por marca, em colunas paralelas: (modelos em maiúsculas, anos iniciais, anos finais, veículos)
+        self._brand_columns = {}
+        categories = set()
+        quotas = set()
+        shared_values = {}
         
         for vehicle in self.vehicles:
+            # Reutilizar um único objeto str para valores repetidos
+            for key in _SHARED_VALUE_FIELDS:
+                value = vehicle.get(key)
+                if isinstance(value, str):
+                    vehicle[key] = shared_values.setdefault(value, value)
+            
             # Índice por Código FIPE
             fipe = str(vehicle.get('Código Fipe', '')).strip()
             if fipe:
@@ -46,72 +89,106 @@ class VehicleDatabase:
                 if model not in self.by_model:
                     self.by_model[model] = []
                 self.by_model[model].append(vehicle)
+            
+            # Campos normalizados para a busca por marca e modelo
+            if brand:
+                ano_ini, ano_fim = _parse_year_range(vehicle)
+                if brand not in self._brand_columns:
+                    self._brand_columns[brand] = ([], [], [], [])
+                models, anos_ini, anos_fim, vehicles = self._brand_columns[brand]
+                models.append(model)
+                anos_ini.append(ano_ini)
+                anos_fim.append(ano_fim)
+                vehicles.append(vehicle)
+            
+            # Categorias e cotas únicas
+            cat = vehicle.get('Categoria')
+            if cat and str(cat).strip() != '':
+                categories.add(str(cat).strip())
+            quota = vehicle.get('Cota')
+            if quota and str(quota).strip() != '':
+                quotas.add(str(quota).strip())
+        
+        self._categories = tuple(sorted(categories))
+        self._quotas = tuple(sorted(quotas))
+        
+        # Marcas ordenadas e em minúsculas, usadas pelo parser a cada consulta
+        self._sorted_brands = tuple(sorted(self.by_brand.keys()))
+        self._brands_by_lower = {b.lower(): b for b in self._sorted_brands}
+        
+        # Uma única expressão com todas as marcas (mais longas primeiro), para
+        # detectar a marca com uma só varredura da consulta
+        self._brand_re = None
+        if self._brands_by_lower:
+            alternatives = sorted(self._brands_by_lower, key=len, reverse=True)
+            self._brand_re = re.compile('|'.join(re.escape(b) for b in alternatives))
     
     def search_by_fipe(self, fipe_code: str) -> Optional[Dict]:
         """Buscar veículo por Código FIPE"""
         fipe = str(fipe_code).strip()
-        return self.by_fipe.get(fipe)
+        return self._search_by_fipe_raw(fipe)
+    
+    def _search_by_fipe_raw(self, fipe_code: str) -> Optional[Dict]:
+        """Buscar veículo por Código FIPE já normalizado (sem espaços)"""
+        return self.by_fipe.get(fipe_code)
     
     def search_by_brand_and_model(self, brand: str, model: str, year: Optional[int] = None) -> List[Dict]:
         """Buscar veículos por Marca e Modelo"""
         brand_upper = brand.strip().upper()
         model_upper = model.strip().upper()
         
-        results = []
-        
-        if brand_upper in self.by_brand:
-            for vehicle in self.by_brand[brand_upper]:
-                vehicle_model = str(vehicle.get('Modelo', '')).strip().upper()
-                
-                # Verificar se o modelo contém a busca
-                if model_upper in vehicle_model or self._similarity(model_upper, vehicle_model) > 0.7:
-                    # Se o ano foi fornecido, filtrar por ano
-                    if year:
-                        ano_inicial = vehicle.get('Ano inicial')
-                        ano_final = vehicle.get('Ano final')
-                        if ano_inicial and ano_final:
-                            try:
-                                if int(ano_inicial) <= year <= int(ano_final):
-                                    results.append(vehicle)
-                            except (ValueError, TypeError):
-                                results.append(vehicle)
-                        else:
-                            results.append(vehicle)
-                    else:
-                        results.append(vehicle)
-        
-        return results
+        # O ano pode vir como texto (ex.: da IA); ano inválido não filtra
+        try:
+            year = int(year) if year else None
+        except (TypeError, ValueError):
+            year = None
+        
+        if brand_upper not in self._brand_columns:
+            return []
+        models, anos_ini, anos_fim, vehicles = self._brand_columns[brand_upper]
+        
+        # Se o ano foi fornecido, filtrar primeiro pela coluna de anos (faixa inválida não filtra),
+        # para comparar os modelos apenas nos veículos restantes
+        if year:
+            candidates = [
+                i for i, (ano_ini, ano_fim) in enumerate(zip(anos_ini, anos_fim))
+                if ano_ini <= year <= ano_fim
+            ]
+        else:
+            candidates = range(len(vehicles))
+        
+        # Vários veículos compartilham o mesmo modelo (anos/versões diferentes),
+        # então a comparação é feita uma única vez por modelo distinto
+        unique_models = list(dict.fromkeys(models[i] for i in candidates))
+        
+        # Verificar se o modelo contém a busca ou é suficientemente similar
+        matched = {m for m in unique_models if model_upper in m}
+        matched.update(
+            m for m, score, _ in process.extract(
+                model_upper, unique_models, scorer=fuzz.ratio, processor=None,
+                limit=None, score_cutoff=70
+            )
+            if score > 70
+        )
+        
+        return [vehicles[i] for i in candidates if models[i] in matched]
     
     def search_by_brand(self, brand: str) -> List[Dict]:
         """Buscar todos os veículos de uma marca"""
         brand_upper = brand.strip().upper()
         return self.by_brand.get(brand_upper, [])
     
-    def _similarity(self, a: str, b: str) -> float:
-        """Calcular similaridade entre duas strings"""
-        return SequenceMatcher(None, a, b).ratio()
-    
-    def get_all_brands(self) -> List[str]:
+    def get_all_brands(self) -> Tuple[str, ...]:
         """Obter lista de todas as marcas"""
-        return sorted(list(self.by_brand.keys()))
+        return self._sorted_brands
     
-    def get_categories(self) -> List[str]:
+    def get_categories(self) -> Tuple[str, ...]:
         """Obter lista de categorias únicas"""
-        categories = set()
-        for vehicle in self.vehicles:
-            cat = vehicle.get('Categoria')
-            if cat and str(cat).strip() != '':
-                categories.add(str(cat).strip())
-        return sorted(list(categories))
+        return self._categories
     
-    def get_quotas(self) -> List[str]:
+    def get_quotas(self) -> Tuple[str, ...]:
         """Obter lista de cotas únicas"""
-        quotas = set()
-        for vehicle in self.vehicles:
-            quota = vehicle.get('Cota')
-            if quota and str(quota).strip() != '':
-                quotas.add(str(quota).strip())
-        return sorted(list(quotas))
+        return self._quotas
 
 
 class VehicleSearchParser:
@@ -133,25 +210,20 @@ class VehicleSearchParser:
             'raw_query': query
         }
         
-        # Padrão para Código FIPE (6 dígitos + hífen + 1 dígito)
-        fipe_pattern = r'\d{6}-\d'
-        fipe_match = re.search(fipe_pattern, query)
+        fipe_match = _FIPE_RE.search(query)
         if fipe_match:
             result['fipe_code'] = fipe_match.group(0)
         
-        # Padrão para ano (4 dígitos entre 1900 e 2100)
-        year_pattern = r'\b(19|20)\d{2}\b'
-        year_match = re.search(year_pattern, query)
+        year_match = _YEAR_RE.search(query)
         if year_match:
             result['year'] = int(year_match.group(0))
         
         # Extrair marca e modelo por palavras-chave
         # Procurar por marcas conhecidas
-        brands = self.db.get_all_brands()
-        for brand in brands:
-            if brand.lower() in query.lower():
-                result['brand'] = brand
-                break
+        if self.db._brand_re:
+            brand_match = self.db._brand_re.search(query.lower())
+            if brand_match:
+                result['brand'] = self.db._brands_by_lower[brand_match.group(0)]
         
         return result
     
@@ -161,7 +233,8 @@ class VehicleSearchParser:
         
         # Se temos Código FIPE, buscar por ele
         if parsed['fipe_code']:
-            vehicle = self.db.search_by_fipe(parsed['fipe_code'])
+            # O código extraído pela expressão regular já vem normalizado
+            vehicle = self.db._search_by_fipe_raw(parsed['fipe_code'])
             if vehicle:
                 return [vehicle]
         
@@ -199,6 +272,9 @@ def format_vehicle_response(vehicle: Dict) -> str:
 
 
 if __name__ == '__main__':
+    import os
+    import tempfile
+    
     # Teste do módulo
     db = VehicleDatabase()
     parser = VehicleSearchParser(db)
@@ -225,3 +301,21 @@ if __name__ == '__main__':
                 print(format_vehicle_response(vehicle))
         else:
             print("Nenhum resultado encontrado")
+    
+    # Teste de ano informado como texto ou inválido (deve buscar sem filtro de ano)
+    print("\n--- Teste de Ano Inválido ---")
+    for year in ("2015", "dois mil", [2015]):
+        results = db.search_by_brand_and_model("Toyota", "Hilux", year)
+        print(f"Ano {year!r}: {len(results)} resultado(s)")
+    
+    # Teste de base com ano infinito (NaN/Infinity exportados da planilha)
+    print("\n--- Teste de Ano Infinito ---")
+    with tempfile.NamedTemporaryFile('w', suffix='.json', encoding='utf-8', delete=False) as f:
+        f.write('[{"Código Fipe": "000000-0", "Montadora": "Ford", "Modelo": "KA", '
+                '"Ano inicial": 2000, "Ano final": Infinity}]')
+    try:
+        inf_db = VehicleDatabase(f.name)
+        results = inf_db.search_by_brand_and_model("Ford", "KA", 2015)
+        print(f"Ano final Infinity: {len(results)} resultado(s)")
+    finally:
+        os.remove(f.name)
@@ -3,14 +3,17 @@ Bot WhatsApp para busca de categorias e cotas de veículos
 Integrado com FastAPI e OpenAI para processamento de linguagem natural
 """
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.responses import PlainTextResponse
 import os
 import json
+import functools
 import logging
-from typing import Optional
+import threading
+import requests
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 from vehicle_search import VehicleDatabase, VehicleSearchParser, format_vehicle_response
-from openai import OpenAI
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -23,9 +26,6 @@ app = FastAPI(title="WhatsApp Vehicle Bot")
 db = VehicleDatabase()
 parser = VehicleSearchParser(db)
 
-# Inicializar cliente OpenAI
-client = OpenAI()
-
 # Configurações do WhatsApp (Meta Cloud API)
 WHATSAPP_API_VERSION = "v18.0"
 WHATSAPP_BUSINESS_ACCOUNT_ID = os.getenv("WHATSAPP_BUSINESS_ACCOUNT_ID", "")
@@ -36,60 +36,150 @@ VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "sua_chave_verificacao")
 # URL base da API do WhatsApp
 WHATSAPP_API_URL = f"https://graph.instagram.com/{WHATSAPP_API_VERSION}/{WHATSAPP_PHONE_NUMBER_ID}/messages"
 
+# Instruções de sistema para extração de veículos (resposta em modo JSON da OpenAI)
+VEHICLE_INFO_FORMAT = (
+    '{"brand": str|null, "model": str|null, "year": int|null, "fipe_code": str|null, '
+    '"query_type": "fipe"|"brand_model"|"brand_only"|"unknown"}'
+)
+VEHICLE_EXTRACTION_PROMPT = f'Extraia o veículo da mensagem e responda só em JSON: {VEHICLE_INFO_FORMAT}'
+VEHICLE_BATCH_EXTRACTION_PROMPT = (
+    'Extraia o veículo de cada mensagem da lista JSON e responda só em JSON: '
+    f'{{"results": [um objeto por mensagem, na mesma ordem]}}, cada objeto no formato {VEHICLE_INFO_FORMAT}'
+)
+
+# Sessão HTTP reutilizada entre envios (mantém a conexão TLS aberta)
+whatsapp_session = requests.Session()
+whatsapp_session.headers.update({"Content-Type": "application/json"})
+
+
+@functools.lru_cache(maxsize=1)
+def _get_openai_client():
+    """Inicializar o cliente OpenAI no primeiro uso"""
+    from openai import OpenAI
+    return OpenAI()
+
+
+# Cache (LRU) das extrações da IA: mensagem normalizada -> JSON (como texto) da resposta
+VEHICLE_INFO_CACHE_SIZE = 4096
+_vehicle_info_cache = OrderedDict()
+_vehicle_info_cache_lock = threading.Lock()
+
+
+def _get_cached_vehicle_info(normalized_message: str) -> Optional[str]:
+    """Obter a extração em cache de uma mensagem normalizada (None se ausente)"""
+    with _vehicle_info_cache_lock:
+        content = _vehicle_info_cache.get(normalized_message)
+        if content is not None:
+            _vehicle_info_cache.move_to_end(normalized_message)
+        return content
+
+
+def _cache_vehicle_info(normalized_message: str, content: str) -> None:
+    """Guardar a extração de uma mensagem normalizada, descartando a menos usada se cheio"""
+    with _vehicle_info_cache_lock:
+        _vehicle_info_cache[normalized_message] = content
+        _vehicle_info_cache.move_to_end(normalized_message)
+        if len(_vehicle_info_cache) > VEHICLE_INFO_CACHE_SIZE:
+            _vehicle_info_cache.popitem(last=False)
+
+
+def _extract_vehicle_info_cached(normalized_message: str) -> str:
+    """
+    Chamar a IA para uma mensagem normalizada e retornar o JSON (como texto) da resposta.
+    Erros da API e respostas que não são JSON válido geram exceção e não entram no cache.
+    """
+    content = _get_cached_vehicle_info(normalized_message)
+    if content is not None:
+        return content
+    
+    response = _get_openai_client().chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=[
+            {"role": "system", "content": VEHICLE_EXTRACTION_PROMPT},
+            {"role": "user", "content": normalized_message}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0,
+        max_tokens=80
+    )
+    
+    # Validar o JSON antes de guardar no cache
+    content = response.choices[0].message.content
+    json.loads(content)
+    _cache_vehicle_info(normalized_message, content)
+    return content
+
 
 def extract_vehicle_info_with_ai(user_message: str) -> dict:
     """
     Usar IA para extrair informações de veículos da mensagem do usuário
+    (mensagens repetidas são respondidas a partir do cache)
     """
     try:
-        prompt = f"""
-Você é um assistente especializado em extrair informações de veículos de mensagens de usuários.
-Analise a seguinte mensagem e extraia as informações do veículo:
+        return json.loads(_extract_vehicle_info_cached(user_message.strip().lower()))
+    except json.JSONDecodeError as e:
+        logger.warning(f"Falha ao fazer parse de JSON da IA: {e.doc}")
+        return {"query_type": "unknown"}
+    except Exception as e:
+        logger.error(f"Erro ao chamar OpenAI: {e}")
+        return {"query_type": "unknown"}
 
-Mensagem: "{user_message}"
 
-Responda em JSON com os seguintes campos:
-- brand: marca do veículo (ex: Toyota, Ford, etc)
-- model: modelo do veículo
-- year: ano do veículo (se mencionado)
-- fipe_code: código FIPE (se mencionado)
-- query_type: tipo de busca ('fipe', 'brand_model', 'brand_only', 'unknown')
+def _extract_vehicles_info_batch(normalized_messages: List[str]) -> None:
+    """
+    Chamar a IA uma única vez para várias mensagens normalizadas e guardar no cache
+    o JSON (como texto) de cada uma. Respostas inválidas geram exceção e nada é guardado.
+    """
+    response = _get_openai_client().chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=[
+            {"role": "system", "content": VEHICLE_BATCH_EXTRACTION_PROMPT},
+            {"role": "user", "content": json.dumps(normalized_messages, ensure_ascii=False)}
+        ],
+        response_format={"type": "json_object"},
+        temperature=0,
+        max_tokens=80 * len(normalized_messages)
+    )
+    
+    # Validar o JSON antes de guardar no cache
+    content = response.choices[0].message.content
+    results = json.loads(content).get("results")
+    if (not isinstance(results, list) or len(results) != len(normalized_messages)
+            or not all(isinstance(r, dict) for r in results)):
+        raise ValueError(f"Resposta da IA não contém um resultado por mensagem: {content}")
+    
+    for normalized_message, result in zip(normalized_messages, results):
+        _cache_vehicle_info(normalized_message, json.dumps(result, ensure_ascii=False))
 
-Exemplo de resposta:
-{{"brand": "Toyota", "model": "Hilux", "year": 2015, "fipe_code": null, "query_type": "brand_model"}}
 
-Responda APENAS com o JSON, sem explicações adicionais.
-"""
-        
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {"role": "system", "content": "Você é um assistente que extrai informações de veículos em JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.3,
-            max_tokens=200
-        )
-        
-        # Tentar fazer parse do JSON da resposta
+def extract_vehicles_info_with_ai(user_messages: List[str]) -> List[dict]:
+    """
+    Usar IA para extrair informações de veículos de várias mensagens
+    (mensagens fora do cache são extraídas com uma única chamada)
+    """
+    normalized = [m.strip().lower() for m in user_messages]
+    unique = list(dict.fromkeys(normalized))
+    missing = [m for m in unique if _get_cached_vehicle_info(m) is None]
+    
+    if len(missing) > 1:
         try:
-            result = json.loads(response.choices[0].message.content)
-            return result
-        except json.JSONDecodeError:
-            logger.warning(f"Falha ao fazer parse de JSON da IA: {response.choices[0].message.content}")
-            return {"query_type": "unknown"}
-            
-    except Exception as e:
-        logger.error(f"Erro ao chamar OpenAI: {e}")
-        return {"query_type": "unknown"}
+            _extract_vehicles_info_batch(missing)
+        except Exception as e:
+            # Se o lote falhar, cada mensagem é extraída individualmente abaixo
+            logger.warning(f"Falha na extração em lote, extraindo mensagem a mensagem: {e}")
+    
+    by_message = {m: extract_vehicle_info_with_ai(m) for m in unique}
+    return [dict(by_message[m]) for m in normalized]
 
 
-def search_vehicles(user_message: str) -> list:
+def search_vehicles(user_message: str, vehicle_info: Optional[dict] = None) -> list:
     """
     Buscar veículos baseado na mensagem do usuário
+    (vehicle_info pode ser informado quando a extração já foi feita em lote)
     """
     # Extrair informações usando IA
-    vehicle_info = extract_vehicle_info_with_ai(user_message)
+    if vehicle_info is None:
+        vehicle_info = extract_vehicle_info_with_ai(user_message)
     
     results = []
     
@@ -149,11 +239,8 @@ def send_whatsapp_message(phone_number: str, message: str) -> bool:
         return False
     
     try:
-        import requests
-        
         headers = {
             "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-            "Content-Type": "application/json",
         }
         
         payload = {
@@ -164,7 +251,7 @@ def send_whatsapp_message(phone_number: str, message: str) -> bool:
             "text": {"preview_url": False, "body": message},
         }
         
-        response = requests.post(WHATSAPP_API_URL, json=payload, headers=headers)
+        response = whatsapp_session.post(WHATSAPP_API_URL, json=payload, headers=headers, timeout=5)
         
         if response.status_code == 200:
             logger.info(f"Message sent successfully to {phone_number}")
@@ -178,6 +265,29 @@ def send_whatsapp_message(phone_number: str, message: str) -> bool:
         return False
 
 
+def process_and_reply(messages: List[Tuple[str, str]]) -> None:
+    """
+    Buscar veículos e enviar as respostas para as mensagens (telefone, texto) de um webhook
+    (executado em segundo plano, após o ack do webhook)
+    """
+    # Extrair informações de todas as mensagens com uma única chamada à IA
+    vehicle_infos = extract_vehicles_info_with_ai([message_text for _, message_text in messages])
+    
+    for (phone_number, message_text), vehicle_info in zip(messages, vehicle_infos):
+        try:
+            # Buscar veículos
+            vehicles = search_vehicles(message_text, vehicle_info)
+            
+            # Formatar resposta
+            response_text = format_whatsapp_response(vehicles)
+            
+            # Enviar resposta
+            send_whatsapp_message(phone_number, response_text)
+            
+        except Exception as e:
+            logger.error(f"Error replying to {phone_number}: {e}")
+
+
 @app.get("/webhook")
 async def verify_webhook(request: Request):
     """
@@ -195,7 +305,7 @@ async def verify_webhook(request: Request):
 
 
 @app.post("/webhook")
-async def handle_webhook(request: Request):
+async def handle_webhook(request: Request, background_tasks: BackgroundTasks):
     """
     Processar mensagens recebidas do WhatsApp
     """
@@ -212,21 +322,17 @@ async def handle_webhook(request: Request):
             value = changes.get("value", {})
             messages = value.get("messages", [])
             
-            if messages:
-                message = messages[0]
+            pending = []
+            for message in messages:
                 phone_number = message.get("from")
                 message_text = message.get("text", {}).get("body", "")
                 
                 logger.info(f"Message from {phone_number}: {message_text}")
-                
-                # Buscar veículos
-                vehicles = search_vehicles(message_text)
-                
-                # Formatar resposta
-                response_text = format_whatsapp_response(vehicles)
-                
-                # Enviar resposta
-                send_whatsapp_message(phone_number, response_text)
+                pending.append((phone_number, message_text))
+            
+            if pending:
+                # Buscar e responder depois de confirmar o recebimento à Meta
+                background_tasks.add_task(process_and_reply, pending)
         
         return {"status": "ok"}
         